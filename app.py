@@ -1,5 +1,7 @@
 import os
+import shutil
 import streamlit as st
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 from dotenv import load_dotenv
 
@@ -12,6 +14,20 @@ ELEVEN_KEY = os.getenv("ELEVENLABS_API_KEY")
 
 st.set_page_config(page_title="VoiceClone-PDF-Audiobook", layout="wide")
 
+# Build each converter once and share it across reruns and sessions
+@st.cache_resource
+def get_converter():
+    return PDFToSpeech()
+
+@st.cache_resource
+def get_cloner():
+    return PDFToSpeechWithVoiceCloning()
+
+def save_upload(uploaded_file, path):
+    """Stream an uploaded file to disk in 1 MiB blocks"""
+    with open(path, "wb") as f:
+        shutil.copyfileobj(uploaded_file, f, length=1 << 20)
+
 st.title("🎧 VoiceClone-PDF-Audiobook")
 st.write("Convert PDF pages into audiobooks using ElevenLabs or Coqui TTS, with optional voice cloning.")
 
@@ -25,12 +41,11 @@ os.makedirs("uploads", exist_ok=True)
 
 if pdf_file:
     pdf_path = Path("uploads") / pdf_file.name
-    with open(pdf_path, "wb") as f:
-        f.write(pdf_file.read())
+    save_upload(pdf_file, pdf_path)
 
     if st.button("Extract & Convert"):
         if engine == "ElevenLabs":
-            converter = PDFToSpeech()
+            converter = get_converter()
             voice_id = st.text_input("Enter ElevenLabs Voice ID", "JBFqnCBsd6RMkjVDRZzb")
 
             if voice_id:
@@ -40,7 +55,7 @@ if pdf_file:
                     st.audio(str(audio_path))
 
         elif engine == "Coqui TTS":
-            converter = PDFToSpeechWithVoiceCloning()
+            converter = get_cloner()
             text_file = converter.extract_page_text(pdf_path, page_number)
             st.info("Use Voice Cloning section below to generate narration.")
 
@@ -53,12 +68,25 @@ if ref_audio and text_file and st.button("Clone Voice & Generate Audio"):
     ref_path = Path("uploads") / ref_audio.name
     txt_path = Path("uploads") / text_file.name
 
-    with open(ref_path, "wb") as f:
-        f.write(ref_audio.read())
-    with open(txt_path, "wb") as f:
-        f.write(text_file.read())
+    # Write uploads in the background, overlapping model load and
+    # speaker conditioning with the remaining file I/O
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        ref_future = executor.submit(save_upload, ref_audio, ref_path)
+        txt_future = executor.submit(save_upload, text_file, txt_path)
+
+        cloner = get_cloner()
+        ref_future.result()
+        try:
+            conditioning = cloner.get_speaker_conditioning(str(ref_path))
+        except Exception as e:
+            conditioning = None
+            print(f"❌ Error computing speaker conditioning: {e}")
+        txt_future.result()
+
+    if conditioning is None:
+        st.error("Could not prepare the reference voice. Check the audio file and try again.")
+        st.stop()
 
-    cloner = PDFToSpeechWithVoiceCloning()
     result = cloner.process_text_with_voice_clone(str(txt_path), str(ref_path), language="en")
 
     if result:
@@ -1,15 +1,52 @@
 import os
+
+# One BLAS/OpenMP thread per process: CPU TTS inference slows down badly when
+# PyTorch oversubscribes every core. Override by exporting OMP_NUM_THREADS.
+# Must be set before torch is imported.
+os.environ.setdefault("OMP_NUM_THREADS", "1")
+os.environ.setdefault("MKL_NUM_THREADS", "1")
+
+# Variable-length chunks fragment the CUDA caching allocator; expandable
+# segments let it grow blocks in place instead of reserving new ones.
+os.environ.setdefault("PYTORCH_CUDA_ALLOC_CONF", "expandable_segments:True,max_split_size_mb:128")
+
 import re
 import shutil
+import logging
+import pickle
+import inspect
+import hashlib
+import threading
+import contextlib
+from collections import OrderedDict
 from pathlib import Path
 import torch
 import torchaudio
 import numpy as np
+from torch.nn.utils.rnn import pad_sequence
 from TTS.api import TTS
 import soundfile as sf
 
+logging.getLogger("TTS").setLevel(logging.WARNING)
+
+try:
+    import julius
+except ImportError:
+    julius = None
+
+try:
+    import av
+except ImportError:
+    av = None
+
 class PDFToSpeechWithVoiceCloning:
-    def __init__(self):
+    # Sentence boundary: whitespace following terminal punctuation
+    _SENT_RE = re.compile(r'(?<=[.!?])\s+')
+    
+    # Pause after each chunk, as the Coqui synthesizer appends after each sentence
+    _PAUSE_SAMPLES = 10000
+    
+    def __init__(self, model_name="tts_models/multilingual/multi-dataset/your_tts", progress_bar=False):
         self.output_dir = Path("audio_output")
         self.output_dir.mkdir(exist_ok=True)
         
@@ -17,8 +54,40 @@ class PDFToSpeechWithVoiceCloning:
         self.device = "cuda" if torch.cuda.is_available() else "cpu"
         print(f"🔧 Using device: {self.device}")
         
-        # Clear corrupted model cache and setup TTS
-        self.setup_tts_model()
+        if self.device == "cpu":
+            # OpenMP allows a per-nesting-level list ("4,2"); the first level applies here
+            try:
+                num_threads = max(1, int(os.environ["OMP_NUM_THREADS"].split(",")[0]))
+            except ValueError:
+                num_threads = 1
+            torch.set_num_threads(num_threads)
+            try:
+                torch.set_num_interop_threads(num_threads)
+            except RuntimeError:
+                # Can only be set once per process, before any parallel work
+                pass
+            print(f"🧵 CPU threads: {num_threads}")
+        
+        # Mixed precision for GPU inference (bf16 on Ampere+, fp16 otherwise)
+        self.amp_dtype = None
+        if self.device == "cuda":
+            self.amp_dtype = torch.bfloat16 if torch.cuda.is_bf16_supported() else torch.float16
+            print(f"⚡ Using {str(self.amp_dtype).replace('torch.', '')} autocast")
+        
+        # LRU cache of speaker conditioning keyed by reference-audio hash
+        self._spk_cache = OrderedDict()
+        self._spk_cache_size = 16
+        
+        # The model and speaker cache may be shared by several Streamlit sessions
+        # (re-entrant: generation warms the speaker cache while holding it)
+        self._lock = threading.RLock()
+        
+        # Setup TTS (model cache is only cleared if loading fails)
+        self.setup_tts_model(model_name, progress_bar)
+        
+        # Release blocks left over from loading the weights
+        if self.device == "cuda":
+            torch.cuda.empty_cache()
     
     def clear_model_cache(self):
         """Clear potentially corrupted model cache"""
@@ -32,23 +101,25 @@ class PDFToSpeechWithVoiceCloning:
         except Exception as e:
             print(f"⚠️  Could not clear cache: {e}")
     
-    def setup_tts_model(self):
+    def setup_tts_model(self, model_name, progress_bar=False):
         """Initialize Coqui TTS model for voice cloning"""
         print("🚀 Setting up Coqui TTS model for voice cloning...")
         
         try:
-            # Clear cache first to avoid corruption
-            self.clear_model_cache()
-            
-            # Use YourTTS model as you specified
-            model_name = "tts_models/multilingual/multi-dataset/your_tts"
+            # YourTTS by default; XTTS models are also supported
             print(f"📥 Loading model: {model_name}")
             
-            self.tts = TTS(model_name=model_name, progress_bar=True)
+            try:
+                self.tts = TTS(model_name=model_name, progress_bar=progress_bar)
+            except (RuntimeError, EOFError, pickle.UnpicklingError) as e:
+                # Cached weights look corrupted: clear the cache and download once more
+                print(f"⚠️  Model load failed ({e}), retrying with a fresh download...")
+                self.clear_model_cache()
+                self.tts = TTS(model_name=model_name, progress_bar=progress_bar)
             if self.device == "cuda":
                 self.tts = self.tts.to(self.device)
             
-            print("✅ YourTTS model loaded successfully!")
+            print(f"✅ {model_name.split('/')[-1]} model loaded successfully!")
             
         except Exception as e:
             print(f"❌ Error loading TTS model: {e}")
@@ -78,6 +149,15 @@ class PDFToSpeechWithVoiceCloning:
             print(f"❌ Error loading text file: {e}")
             return ""
     
+    def check_reference_duration(self, duration):
+        """Warn when reference audio is too short or too long for good cloning"""
+        print(f"   ⏱️  Audio duration: {duration:.2f} seconds")
+        
+        if duration < 3:
+            print("⚠️  Warning: Audio is very short. For better cloning, use 10+ seconds")
+        elif duration > 120:
+            print("⚠️  Warning: Audio is very long. Consider trimming to 30-60 seconds")
+    
     def prepare_reference_audio(self, audio_path):
         """Prepare reference audio for voice cloning with better format handling"""
         audio_path = Path(audio_path)
@@ -88,6 +168,20 @@ class PDFToSpeechWithVoiceCloning:
         print(f"\n🎤 Preparing reference audio: {audio_path.name}")
         
         try:
+            # Already a mono 22050 Hz WAV: use it as-is, no decode/resample/rewrite
+            if audio_path.suffix.lower() == '.wav':
+                try:
+                    info = sf.info(str(audio_path))
+                except RuntimeError:
+                    # Unreadable header (sf.LibsndfileError is a RuntimeError):
+                    # fall through to the full decode path
+                    info = None
+                
+                if info is not None and info.samplerate == 22050 and info.channels == 1:
+                    print("   ✅ Already mono 22050 Hz WAV, using as-is")
+                    self.check_reference_duration(info.duration)
+                    return str(audio_path)
+            
             # Try multiple methods to load audio
             waveform = None
             sample_rate = None
@@ -101,9 +195,9 @@ class PDFToSpeechWithVoiceCloning:
                 
                 # Method 2: Try with soundfile
                 try:
-                    import soundfile as sf
-                    audio_data, sample_rate = sf.read(str(audio_path))
-                    waveform = torch.tensor(audio_data).unsqueeze(0)
+                    # float32 frames, viewed channels-first without copying
+                    audio_data, sample_rate = sf.read(str(audio_path), dtype='float32', always_2d=True)
+                    waveform = torch.from_numpy(audio_data.T)
                     print("   ✅ Loaded with soundfile")
                 except Exception as e2:
                     print(f"   ⚠️  soundfile failed: {e2}")
@@ -124,23 +218,21 @@ class PDFToSpeechWithVoiceCloning:
             
             # Resample to 22050 Hz if needed
             if sample_rate != 22050:
-                resampler = torchaudio.transforms.Resample(sample_rate, 22050)
-                waveform = resampler(waveform)
+                if julius is not None:
+                    waveform = julius.resample_frac(waveform.float(), int(sample_rate), 22050)
+                else:
+                    resampler = torchaudio.transforms.Resample(sample_rate, 22050)
+                    waveform = resampler(waveform)
                 sample_rate = 22050
                 print(f"   🔄 Resampled to {sample_rate} Hz")
             
             # Check audio length
-            duration = waveform.shape[1] / sample_rate
-            print(f"   ⏱️  Audio duration: {duration:.2f} seconds")
-            
-            if duration < 3:
-                print("⚠️  Warning: Audio is very short. For better cloning, use 10+ seconds")
-            elif duration > 120:
-                print("⚠️  Warning: Audio is very long. Consider trimming to 30-60 seconds")
+            self.check_reference_duration(waveform.shape[1] / sample_rate)
             
-            # Save as compatible WAV file
+            # Save as compatible 16-bit PCM WAV file (clipped to avoid wrap-around)
             output_path = self.output_dir / f"processed_{audio_path.stem}.wav"
-            torchaudio.save(str(output_path), waveform, sample_rate)
+            samples = np.clip(waveform.squeeze(0).numpy(), -1.0, 1.0)
+            sf.write(str(output_path), samples, sample_rate, subtype='PCM_16')
             print(f"   💾 Processed audio saved: {output_path}")
             
             return str(output_path)
@@ -149,11 +241,38 @@ class PDFToSpeechWithVoiceCloning:
             print(f"❌ Error preparing reference audio: {e}")
             return None
     
+    def decode_with_av(self, audio_path, output_path):
+        """Decode and resample audio to 22050 Hz mono WAV in-process with PyAV"""
+        resampler = av.AudioResampler(format='s16', layout='mono', rate=22050)
+        pcm = []
+        
+        with av.open(str(audio_path)) as container:
+            stream = container.streams.audio[0]
+            for frame in container.decode(stream):
+                for resampled in resampler.resample(frame):
+                    pcm.append(resampled.to_ndarray().reshape(-1))
+            
+            # Flush samples still buffered in the resampler
+            for resampled in resampler.resample(None):
+                pcm.append(resampled.to_ndarray().reshape(-1))
+        
+        sf.write(str(output_path), np.concatenate(pcm), 22050, subtype='PCM_16')
+        return output_path
+    
     def convert_audio_format(self, audio_path):
-        """Convert audio to WAV format using ffmpeg"""
+        """Convert audio to WAV format using PyAV, falling back to the ffmpeg binary"""
+        output_path = self.output_dir / f"converted_{audio_path.stem}.wav"
+        
+        if av is not None:
+            try:
+                self.decode_with_av(audio_path, output_path)
+                print(f"   ✅ Converted with PyAV to: {output_path}")
+                return output_path
+            except Exception as e:
+                print(f"   ⚠️  PyAV conversion failed: {e}")
+        
         try:
             import subprocess
-            output_path = self.output_dir / f"converted_{audio_path.stem}.wav"
             
             cmd = [
                 'ffmpeg', '-i', str(audio_path), 
@@ -177,85 +296,228 @@ class PDFToSpeechWithVoiceCloning:
             print(f"   ❌ Conversion error: {e}")
             return None
     
-    def clone_voice_and_generate(self, text, reference_audio_path, language="en", save_audio=True):
+    def _reference_key(self, audio_path):
+        """Build a cache key from the first 1 MB of the reference file"""
+        digest = hashlib.blake2b(digest_size=16)
+        with open(audio_path, 'rb') as f:
+            digest.update(f.read(1 << 20))
+        return (digest.hexdigest(), audio_path.stat().st_size, 22050)
+    
+    def _model_splits_text(self):
+        """Whether the loaded model can split long text itself (XTTS)"""
+        inference = self.tts.synthesizer.tts_model.inference
+        return "enable_text_splitting" in inspect.signature(inference).parameters
+    
+    def compute_speaker_embedding(self, ref_audio_path):
+        """Compute the speaker conditioning for a prepared reference clip"""
+        print("🧬 Computing speaker embedding...")
+        model = self.tts.synthesizer.tts_model
+        with torch.inference_mode():
+            if hasattr(model, "get_conditioning_latents"):
+                # XTTS conditions on (gpt_cond_latent, speaker_embedding)
+                return model.get_conditioning_latents(audio_path=[ref_audio_path])
+            embedding = model.speaker_manager.compute_embedding_from_clip(ref_audio_path)
+        
+        return torch.as_tensor(embedding, dtype=torch.float32).reshape(1, -1).to(self.device)
+    
+    def get_speaker_conditioning(self, reference_audio_path):
+        """Return (speaker_embedding, processed_audio_path), cached per reference audio"""
+        audio_path = Path(reference_audio_path)
+        
+        if not audio_path.exists():
+            raise FileNotFoundError(f"Reference audio file '{audio_path}' not found!")
+        
+        with self._lock:
+            key = self._reference_key(audio_path)
+            if key in self._spk_cache:
+                self._spk_cache.move_to_end(key)
+                print(f"\n♻️  Reusing cached speaker conditioning for: {audio_path.name}")
+                return self._spk_cache[key]
+            
+            ref_audio_path = self.prepare_reference_audio(audio_path)
+            if ref_audio_path is None:
+                return None
+            
+            speaker_embedding = self.compute_speaker_embedding(ref_audio_path)
+            
+            self._spk_cache[key] = (speaker_embedding, ref_audio_path)
+            if len(self._spk_cache) > self._spk_cache_size:
+                self._spk_cache.popitem(last=False)
+            
+            return self._spk_cache[key]
+    
+    def synthesize_full_text(self, text, speaker_embedding, language="en"):
+        """Synthesize the whole text in one call, letting the model split sentences"""
+        model = self.tts.synthesizer.tts_model
+        gpt_cond_latent, xtts_speaker_embedding = speaker_embedding
+        
+        # XTTS converts its waveform with .numpy() inside inference(), and numpy
+        # has no bfloat16: only fp16 autocast is safe on this path
+        with torch.inference_mode(), torch.autocast(
+            device_type=self.device,
+            dtype=torch.float16,
+            enabled=self.amp_dtype == torch.float16,
+        ):
+            outputs = model.inference(
+                text=text,
+                language=language,
+                gpt_cond_latent=gpt_cond_latent,
+                speaker_embedding=xtts_speaker_embedding,
+                enable_text_splitting=True,
+            )
+        
+        return np.asarray(outputs["wav"], dtype=np.float32)
+    
+    def synthesize_batch(self, chunks, speaker_embedding, language="en"):
+        """Synthesize several text chunks in one padded forward pass of the model"""
+        model = self.tts.synthesizer.tts_model
+        
+        token_ids = [
+            torch.tensor(model.tokenizer.text_to_ids(chunk, language=language), dtype=torch.long)
+            for chunk in chunks
+        ]
+        x = pad_sequence(token_ids, batch_first=True).to(self.device)
+        x_lengths = torch.tensor([len(ids) for ids in token_ids], device=self.device)
+        
+        language_ids = None
+        if model.language_manager is not None:
+            language_id = model.language_manager.name_to_id[language]
+            language_ids = torch.full((len(chunks),), language_id, dtype=torch.long, device=self.device)
+        
+        with torch.inference_mode(), torch.autocast(
+            device_type=self.device,
+            dtype=self.amp_dtype,
+            enabled=self.amp_dtype is not None,
+        ):
+            outputs = model.inference(
+                x,
+                aux_input={
+                    "x_lengths": x_lengths,
+                    "d_vectors": speaker_embedding.expand(len(chunks), -1),
+                    "language_ids": language_ids,
+                },
+            )
+        
+        # Trim the padded tail of each waveform using the decoder frame mask
+        hop_length = model.config.audio.hop_length
+        wav_lengths = (outputs["y_mask"].sum(dim=(1, 2)) * hop_length).long().tolist()
+        wavs = outputs["model_outputs"].squeeze(1).float().cpu().numpy()
+        
+        return [wav[:length] for wav, length in zip(wavs, wav_lengths)]
+    
+    def clone_voice_and_generate(self, text, reference_audio_path, language="en", save_audio=True, batch_size=4):
         """Clone voice from reference audio and generate speech"""
+        with self._lock:
+            return self._clone_voice_and_generate(text, reference_audio_path, language, save_audio, batch_size)
+    
+    def generate_segments(self, text, speaker_embedding, language="en", batch_size=4):
+        """Yield float32 audio segments for text, in reading order"""
+        if self._model_splits_text():
+            # Model splits sentences in its own tokenizer context
+            print("🔄 Generating with model-side text splitting...")
+            yield self.synthesize_full_text(text, speaker_embedding, language=language)
+            return
+        
+        # Split text into smaller chunks if too long (XTTS has limits)
+        max_chars = 250  # Conservative limit for XTTS
+        text_chunks = [c for c in self.split_text_into_chunks(text, max_chars) if c.strip()]
+        
+        print(f"📊 Split text into {len(text_chunks)} chunks")
+        
+        pause = np.zeros(self._PAUSE_SAMPLES, dtype=np.float32)
+        
+        # Consecutive chunks are batched so audio can be written out in order;
+        # the sentence packer already keeps them at similar lengths
+        for start in range(0, len(text_chunks), batch_size):
+            batch = text_chunks[start:start + batch_size]
+            print(f"🔄 Processing chunks {start+1}-{start+len(batch)}/{len(text_chunks)}...")
+            
+            # Generate speech with cloned voice
+            wavs = self.synthesize_batch(batch, speaker_embedding, language=language)
+            
+            for wav in wavs:
+                yield np.asarray(wav, dtype=np.float32)
+                yield pause
+    
+    def _clone_voice_and_generate(self, text, reference_audio_path, language, save_audio, batch_size):
         if not text.strip():
             raise ValueError("No text provided for conversion!")
         
-        # Prepare reference audio
-        ref_audio_path = self.prepare_reference_audio(reference_audio_path)
-        if ref_audio_path is None:
+        # Prepare reference audio and speaker conditioning (cached per voice)
+        conditioning = self.get_speaker_conditioning(reference_audio_path)
+        if conditioning is None:
             return None
+        speaker_embedding, _ = conditioning
         
         print(f"\n🎭 Cloning voice and generating speech...")
         print(f"📝 Text length: {len(text)} characters")
         print(f"🗣️  Reference audio: {Path(reference_audio_path).name}")
         
         try:
-            # Split text into smaller chunks if too long (XTTS has limits)
-            max_chars = 250  # Conservative limit for XTTS
-            text_chunks = self.split_text_into_chunks(text, max_chars)
-            
-            print(f"📊 Split text into {len(text_chunks)} chunks")
-            
-            audio_segments = []
-            
-            for i, chunk in enumerate(text_chunks):
-                if not chunk.strip():
-                    continue
-                
-                print(f"🔄 Processing chunk {i+1}/{len(text_chunks)}...")
+            # Save audio file if requested, writing each segment as it is generated
+            audio_path = None
+            sink = contextlib.nullcontext()
+            if save_audio:
+                filename = f"cloned_voice_output.wav"
+                audio_path = self.output_dir / filename
                 
-                # Generate speech with cloned voice
-                wav = self.tts.tts(
-                    text=chunk,
-                    speaker_wav=ref_audio_path,
-                    language=language
+                # 16-bit PCM WAV at the model's native output rate
+                sink = sf.SoundFile(
+                    str(audio_path), mode='w',
+                    samplerate=self.tts.synthesizer.output_sample_rate,
+                    channels=1, subtype='PCM_16'
                 )
-                
-                audio_segments.append(wav)
             
-            # Combine all audio segments
-            if audio_segments:
-                combined_audio = np.concatenate(audio_segments)
-                
-                # Save audio file if requested
-                audio_path = None
-                if save_audio:
-                    filename = f"cloned_voice_output.wav"
-                    audio_path = self.output_dir / filename
-                    
-                    # Save as WAV file
-                    sf.write(str(audio_path), combined_audio, 22050)
-                    print(f"💾 Cloned voice audio saved to: {audio_path}")
-                
-                return audio_path
-            else:
+            samples_written = 0
+            with sink as out:
+                for segment in self.generate_segments(text, speaker_embedding, language, batch_size):
+                    if out is not None:
+                        out.write(segment)
+                    samples_written += len(segment)
+            
+            if not samples_written:
                 print("❌ No audio segments generated")
+                if audio_path is not None:
+                    audio_path.unlink(missing_ok=True)
                 return None
             
+            if audio_path is not None:
+                print(f"💾 Cloned voice audio saved to: {audio_path}")
+            
+            return audio_path
+            
         except Exception as e:
             print(f"❌ Error in voice cloning: {e}")
             print(f"💡 Error details: {type(e).__name__}")
             return None
     
+    def _sentence_spans(self, text):
+        """Yield (start, end) offsets of each sentence in text"""
+        start = 0
+        for match in self._SENT_RE.finditer(text):
+            yield start, match.start()
+            start = match.end()
+        yield start, len(text)
+    
     def split_text_into_chunks(self, text, max_chars=250):
         """Split text into smaller chunks for processing"""
-        # Split by sentences first
-        sentences = re.split(r'(?<=[.!?])\s+', text)
         chunks = []
-        current_chunk = ""
+        chunk_start = chunk_end = 0
+        chunk_len = 0  # Length of the chunk with sentences joined by single spaces
         
-        for sentence in sentences:
-            if len(current_chunk + sentence) <= max_chars:
-                current_chunk += sentence + " "
-            else:
-                if current_chunk:
-                    chunks.append(current_chunk.strip())
-                current_chunk = sentence + " "
+        # Pack whole sentences greedily, slicing each chunk straight out of text
+        for start, end in self._sentence_spans(text):
+            if chunk_len and chunk_len + (end - start) > max_chars:
+                chunks.append(text[chunk_start:chunk_end].strip())
+                chunk_len = 0
+            
+            if not chunk_len:
+                chunk_start = start
+            chunk_end = end
+            chunk_len += end - start + 1
         
-        if current_chunk:
-            chunks.append(current_chunk.strip())
+        if chunk_len:
+            chunks.append(text[chunk_start:chunk_end].strip())
         
         return chunks
     
@@ -289,8 +551,8 @@ def main():
     print("=" * 60)
     
     try:
-        # Initialize converter
-        converter = PDFToSpeechWithVoiceCloning()
+        # Initialize converter (progress bar only for interactive CLI runs)
+        converter = PDFToSpeechWithVoiceCloning(progress_bar=True)
         
         text_file = "audio_output/page_20_text.txt"  
         reference_audio = "myvoice.wav"  
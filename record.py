@@ -1,10 +1,13 @@
 import os
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from requests_toolbelt import MultipartEncoder
 from pathlib import Path
 from datetime import datetime
 from dotenv import load_dotenv
 from elevenlabs.client import ElevenLabs
-from elevenlabs import play, save
+from elevenlabs import play
 import json
 
 class ElevenLabsVoiceCloning:
@@ -27,6 +30,15 @@ class ElevenLabsVoiceCloning:
         
         # Base URL for API calls
         self.base_url = "https://api.elevenlabs.io/v1"
+        
+        # Pooled keep-alive session so repeated API calls reuse the TLS connection
+        self.session = requests.Session()
+        self.session.headers.update({"xi-api-key": self.api_key})
+        self.session.mount("https://", HTTPAdapter(
+            pool_connections=4,
+            pool_maxsize=8,
+            max_retries=Retry(total=3, backoff_factor=0.3),
+        ))
     
     def upload_voice_sample(self, audio_file_path, voice_name="Taqi Voice", description="Voice cloned from audio sample"):
         """Upload audio sample and create a cloned voice"""
@@ -48,24 +60,18 @@ class ElevenLabsVoiceCloning:
         try:
             # Prepare the request
             url = f"{self.base_url}/voices/add"
-            headers = {"xi-api-key": self.api_key}
-            
-            # Prepare form data
-            files = {
-                'files': (audio_path.name, open(audio_path, 'rb'), 'audio/wav')
-            }
-            
-            data = {
-                'name': voice_name,
-                'description': description,
-                'labels': json.dumps({"accent": "custom", "description": description})
-            }
             
-            print("🚀 Uploading to ElevenLabs...")
-            response = requests.post(url, headers=headers, files=files, data=data)
-            
-            # Close the file
-            files['files'][1].close()
+            # Stream the multipart form from disk instead of buffering the file
+            with open(audio_path, 'rb') as audio_file:
+                form = MultipartEncoder(fields={
+                    'name': voice_name,
+                    'description': description,
+                    'labels': json.dumps({"accent": "custom", "description": description}),
+                    'files': (audio_path.name, audio_file, 'audio/wav')
+                })
+                
+                print("🚀 Uploading to ElevenLabs...")
+                response = self.session.post(url, data=form, headers={'Content-Type': form.content_type})
             
             if response.status_code == 200:
                 result = response.json()
@@ -104,9 +110,8 @@ class ElevenLabsVoiceCloning:
         """Delete a cloned voice"""
         try:
             url = f"{self.base_url}/voices/{voice_id}"
-            headers = {"xi-api-key": self.api_key}
             
-            response = requests.delete(url, headers=headers)
+            response = self.session.delete(url)
             
             if response.status_code == 200:
                 print(f"✅ Voice {voice_id} deleted successfully")
@@ -155,22 +160,27 @@ class ElevenLabsVoiceCloning:
         print(f"🔊 Converting {len(text)} characters to speech...")
         
         try:
-            # Convert text to speech with cloned voice
-            audio = self.elevenlabs.text_to_speech.convert(
+            # Stream speech with cloned voice as the server renders it
+            # (elevenlabs 2.x renamed convert_as_stream to stream)
+            tts_api = self.elevenlabs.text_to_speech
+            stream = getattr(tts_api, "stream", None) or tts_api.convert_as_stream
+            audio_stream = stream(
                 text=text,
                 voice_id=voice_id,
                 model_id="eleven_multilingual_v2",
                 output_format="mp3_44100_128",
             )
             
-            # Save audio file if requested
+            # Save audio file if requested, writing each chunk as it arrives
             audio_path = None
             if save_audio:
                 timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
                 filename = f"cloned_voice_audiobook_{timestamp}.mp3"
                 audio_path = self.output_dir / filename
                 
-                save(audio, str(audio_path))
+                with open(audio_path, 'wb') as f:
+                    for chunk in audio_stream:
+                        f.write(chunk)
                 print(f"💾 Audio saved to: {audio_path}")
             
             return audio_path
@@ -289,7 +299,7 @@ if __name__ == "__main__":
 # Setup Instructions:
 """
 1. Install required packages:
-   pip install elevenlabs python-dotenv requests
+   pip install elevenlabs python-dotenv requests requests-toolbelt
 
 2. Set up your .env file:
    ELEVENLABS_API_KEY=your_api_key_here
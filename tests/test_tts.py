@@ -0,0 +1,102 @@
+import sys
+import types
+import asyncio
+import threading
+import time
+
+import pytest
+
+
+class FailingChunkAPI:
+    """Async text_to_speech stand-in: the first chunk fails, the rest stream slowly"""
+    
+    def convert(self, text, **kwargs):
+        async def audio():
+            await asyncio.sleep(0.05)
+            if text == "chunk 0":
+                raise RuntimeError("429 Too Many Requests")
+            yield text.encode()
+        return audio()
+
+
+class StreamingAPI:
+    """Sync text_to_speech stand-in streaming a few parts, failing mid-stream on request"""
+    
+    def convert_as_stream(self, text, **kwargs):
+        for i in range(5):
+            time.sleep(0.01)
+            if text == "fail" and i == 2:
+                raise RuntimeError("connection reset")
+            yield f"{text}:{i};".encode()
+
+
+@pytest.fixture
+def converter(monkeypatch, tmp_path):
+    client = types.ModuleType("elevenlabs.client")
+    client.ElevenLabs = lambda **kwargs: types.SimpleNamespace(text_to_speech=StreamingAPI())
+    client.AsyncElevenLabs = lambda **kwargs: types.SimpleNamespace(text_to_speech=FailingChunkAPI())
+    monkeypatch.setitem(sys.modules, "elevenlabs", types.ModuleType("elevenlabs"))
+    monkeypatch.setitem(sys.modules, "elevenlabs.client", client)
+    monkeypatch.chdir(tmp_path)
+    
+    from tts import PDFToSpeech
+    converter = PDFToSpeech(max_concurrent_requests=4)
+    yield converter
+    converter.close()
+
+
+def test_failed_chunk_releases_request_slots(converter):
+    chunks = [f"chunk {i}" for i in range(10)]
+    errors = []
+    
+    def run():
+        try:
+            asyncio.run(converter.convert_chunks(chunks, "voice"))
+        except RuntimeError as e:
+            errors.append(e)
+    
+    # A leaked slot would leave later requests (and this run) waiting forever
+    runner = threading.Thread(target=run, daemon=True)
+    runner.start()
+    runner.join(timeout=5)
+    
+    assert not runner.is_alive()
+    assert [str(e) for e in errors] == ["429 Too Many Requests"]
+    assert all(converter._request_slots.acquire(blocking=False) for _ in range(4))
+
+
+def test_concurrent_writers_of_one_key_keep_the_cache_entry_intact(converter):
+    text = "The same short page."
+    results = [None] * 4
+    
+    def run(i):
+        results[i] = converter.text_to_speech(
+            text, "voice", play_audio=False, filename=f"page_{i}_audio.mp3"
+        )
+    
+    threads = [threading.Thread(target=run, args=(i,)) for i in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    
+    expected = b"".join(f"{text}:{i};".encode() for i in range(5))
+    assert all(path is not None and path.read_bytes() == expected for path in results)
+    assert [p.read_bytes() for p in converter.cache_dir.glob("*.mp3")] == [expected]
+    assert not list(converter.cache_dir.glob("*.part"))
+
+
+def test_failed_stream_leaves_no_partial_file(converter):
+    assert converter.text_to_speech("fail", "voice", play_audio=False) is None
+    assert not list(converter.cache_dir.glob("*.mp3"))
+    assert not list(converter.cache_dir.glob("*.part"))
+
+
+def test_streams_with_the_elevenlabs_2x_method_name(converter):
+    class StreamAPI:
+        stream = StreamingAPI.convert_as_stream
+    
+    converter.elevenlabs.text_to_speech = StreamAPI()
+    audio_path = converter.text_to_speech("A page for the 2.x SDK.", "voice", play_audio=False)
+    
+    assert audio_path.read_bytes().startswith(b"A page for the 2.x SDK.:0;")
@@ -1,25 +1,93 @@
 import os
 import re
-import pdfplumber
+import mmap
+import json
+import time
+import shutil
+import tempfile
+import asyncio
+import hashlib
+import inspect
+import contextlib
+import threading
+import weakref
+import importlib.util
+import httpx
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
 from pathlib import Path
-from datetime import datetime
-from dotenv import load_dotenv
-from elevenlabs.client import ElevenLabs
-from elevenlabs import play, save
-import io
+
+# pdfplumber/pdfminer, dotenv and elevenlabs are imported where they are used:
+# they are slow to import and not every run needs them
+
+try:
+    import pypdfium2 as pdfium
+except ImportError:
+    pdfium = None
+
+# PDFium is not thread-safe, even across documents, and Streamlit runs each
+# session in its own thread: only one thread may be inside pypdfium2 at a time
+_PDFIUM_LOCK = threading.Lock()
+
+# Keep-alive pool shared by all ElevenLabs requests; HTTP/2 when h2 is installed
+_HTTP2 = importlib.util.find_spec("h2") is not None
+_HTTP_LIMITS = httpx.Limits(max_connections=16, max_keepalive_connections=16, keepalive_expiry=60.0)
+# The SDK only applies its own 240 s timeout to clients it creates itself
+_HTTP_TIMEOUT = httpx.Timeout(240.0)
+
+# clean_text patterns, compiled once at import
+_LEADING_PAGE_NUMBER_RE = re.compile(r'^\d+\s*')
+_TRAILING_PAGE_NUMBER_RE = re.compile(r'\s*\d+$')
+_HEADER_RE = re.compile(r'^(Chapter \d+|CHAPTER \d+|Life 3\.0)', re.IGNORECASE)
+_JOINED_RE = re.compile(r'([a-z])(?=[A-Z])|([a-zA-Z])(?=\d)|(\d)(?=[a-zA-Z])')
+_ELLIPSIS_RE = re.compile(r'\.{3,}')
+_DASHES_RE = re.compile(r'-{2,}')
+_PUNCTUATION_SPACING_RE = re.compile(r'\s*([,.!?;:])\s*')
+_SENTENCE_END_RE = re.compile(r'(?<=[.!?])\s+')
+
+class _UnwantedCharsTable(dict):
+    """Lazy str.translate table keeping only word chars, whitespace and essential punctuation"""
+    
+    KEEP = set('.,!?;:\'"()[]{}-–—_')
+    
+    def __missing__(self, codepoint):
+        char = chr(codepoint)
+        keep = char.isalnum() or char.isspace() or char in self.KEEP
+        self[codepoint] = codepoint if keep else None
+        return self[codepoint]
+
+_UNWANTED_CHARS_TABLE = _UnwantedCharsTable()
+
+# Text-showing operators in a raw content stream: Tj, TJ, ' and "
+_TEXT_OPERATOR_RE = re.compile(rb'T[jJ]\b|[)\]>]\s*[\'"]')
 
 class PDFToSpeech:
-    def __init__(self):
+    def __init__(self, cache_max_mb=500, max_concurrent_requests=4):
+        from dotenv import load_dotenv
+        from elevenlabs.client import ElevenLabs
+        
         load_dotenv()
         
-        # Initialize ElevenLabs client
-        self.elevenlabs = ElevenLabs(
-            api_key=os.getenv("ELEVENLABS_API_KEY"),
-        )
+        # Initialize ElevenLabs client (reused for every request in this process)
+        self.api_key = os.getenv("ELEVENLABS_API_KEY")
+        self._http_client = httpx.Client(http2=_HTTP2, limits=_HTTP_LIMITS, timeout=_HTTP_TIMEOUT)
+        self.elevenlabs = ElevenLabs(api_key=self.api_key, httpx_client=self._http_client)
+        # Close the pooled connections even if close() is never called
+        self._close_http_client = weakref.finalize(self, self._http_client.close)
         
         # Create output directory
         self.output_dir = Path("audio_output")
         self.output_dir.mkdir(exist_ok=True)
+        
+        # Content-addressed cache of generated audio, bounded in size
+        self.cache_dir = self.output_dir / "tts_cache"
+        self.cache_dir.mkdir(exist_ok=True)
+        self.cache_index_path = self.cache_dir / "index.json"
+        self.cache_max_bytes = cache_max_mb * 1024 * 1024
+        self._cache_lock = threading.Lock()  # Pages may be synthesized concurrently
+        
+        # One bound on in-flight ElevenLabs requests across all pages and chunks,
+        # so parallel pages can't exceed the provider's concurrency limit
+        self._request_slots = threading.BoundedSemaphore(max_concurrent_requests)
     #     self.available_voices = self.get_voices()
     
     # def get_voices(self):
@@ -39,86 +107,238 @@ class PDFToSpeech:
     #         print("   3. Make sure your ElevenLabs account is active")
     #         return []
     
-    def extract_page_text(self, pdf_path, page_number=1):
-        """Extract text from a specific page of the PDF"""
-        pdf_path = Path(pdf_path)
+    def close(self):
+        """Close the pooled ElevenLabs HTTP connections"""
+        self._close_http_client()
+    
+    @staticmethod
+    def extract_with_pdfium(pdf_path, page_number):
+        """Extract plain text from one page with pypdfium2"""
+        with _PDFIUM_LOCK, contextlib.closing(pdfium.PdfDocument(str(pdf_path))) as pdf:
+            total_pages = len(pdf)
+            print(f"   📄 PDF has {total_pages} total pages")
+            
+            if page_number > total_pages:
+                raise IndexError(f"Page {page_number} not found. PDF has {total_pages} pages.")
+            
+            # Page handles are closed even if text extraction raises
+            with contextlib.closing(pdf[page_number - 1]) as page, \
+                    contextlib.closing(page.get_textpage()) as textpage:
+                # Scanned/image-only page: nothing to read
+                if textpage.count_chars() == 0:
+                    print("   🖼️  Page has no text layer (scanned image?)")
+                    return ""
+                
+                return textpage.get_text_range()
+    
+    @staticmethod
+    def has_text_operators(page_obj):
+        """Cheaply check a pdfminer page for text operators before layout analysis"""
+        from pdfminer.pdftypes import resolve1
+        from pdfminer.psparser import LIT
         
-        if not pdf_path.exists():
-            raise FileNotFoundError(f"PDF file '{pdf_path}' not found!")
+        for stream in page_obj.contents:
+            if _TEXT_OPERATOR_RE.search(resolve1(stream).get_data()):
+                return True
         
-        print(f"\n📖 Extracting text from page {page_number} of '{pdf_path.name}'...")
+        # Text drawn inside form XObjects does not show up in the page stream
+        xobjects = resolve1(page_obj.resources.get("XObject")) or {}
+        return any(resolve1(xobj).get("Subtype") is LIT("Form") for xobj in xobjects.values())
+    
+    @staticmethod
+    def extract_with_pdfplumber(pdf_path, page_number):
+        """Extract text from one page with pdfplumber"""
+        import pdfplumber
+        from pdfminer.pdftypes import resolve1
         
-        try:
-            with pdfplumber.open(pdf_path) as pdf:
-                total_pages = len(pdf.pages)
+        # Memory-map the file so pdfminer's many xref seeks/reads are served from
+        # the page cache rather than separate buffered read syscalls
+        with open(pdf_path, 'rb') as fp, mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            # Only build the requested page; other pages are never parsed
+            with pdfplumber.open(mm, pages=[page_number]) as pdf:
+                # Page count straight from the page tree, without loading every page
+                total_pages = resolve1(pdf.doc.catalog["Pages"])["Count"]
                 print(f"   📄 PDF has {total_pages} total pages")
                 
                 if page_number > total_pages:
                     raise IndexError(f"Page {page_number} not found. PDF has {total_pages} pages.")
                 
-                page = pdf.pages[page_number - 1]
-                text = page.extract_text()
+                page = pdf.pages[0]
                 
-                if not text:
-                    print("⚠️  Warning: No text found on this page!")
+                # Scanned/image-only page: skip the layout engine entirely
+                if not PDFToSpeech.has_text_operators(page.page_obj):
+                    print("   🖼️  Page has no text layer (scanned image?)")
                     return ""
                 
-                print(f"   ✅ Extracted {len(text)} characters from page {page_number}")
-                return text
-                
+                return page.extract_text()
+    
+    @staticmethod
+    def extract_page_text(pdf_path, page_number=1):
+        """Extract text from a specific page of the PDF"""
+        pdf_path = Path(pdf_path)
+        
+        if not pdf_path.exists():
+            raise FileNotFoundError(f"PDF file '{pdf_path}' not found!")
+        
+        print(f"\n📖 Extracting text from page {page_number} of '{pdf_path.name}'...")
+        
+        try:
+            # pypdfium2 is much cheaper for plain text; pdfplumber is the fallback
+            text = None
+            if pdfium is not None:
+                try:
+                    text = PDFToSpeech.extract_with_pdfium(pdf_path, page_number)
+                except IndexError:
+                    raise
+                except Exception as e:
+                    print(f"   ⚠️  pypdfium2 failed: {e}")
+            
+            if text is None:
+                text = PDFToSpeech.extract_with_pdfplumber(pdf_path, page_number)
+            
+            if not text:
+                print("⚠️  Warning: No text found on this page!")
+                return ""
+            
+            print(f"   ✅ Extracted {len(text)} characters from page {page_number}")
+            return text
+            
         except Exception as e:
-            print(f"❌ Error extracting with pdfplumber: {e}")
+            print(f"❌ Error extracting text: {e}")
             return ""
     
-    def clean_text(self, text):
+    def clean_text(self, text, min_chars=50, min_alpha_ratio=0.4):
         if not text:
             return ""
         
         print("\n🧹 Cleaning extracted text...")
         
-        # Remove extra whitespace and normalize line breaks
-        text = re.sub(r'\n+', ' ', text)
-        text = re.sub(r'\s+', ' ', text)
+        # Mostly headers, page numbers or figure labels: not worth cleaning or narrating
+        alpha = sum(map(str.isalpha, text))
+        if len(text) < min_chars or alpha < len(text) * min_alpha_ratio:
+            print(f"⚠️  Warning: Page looks non-textual ({len(text)} chars, {alpha} letters), skipping")
+            return ""
+        
+        # Remove extra whitespace and normalize line breaks (also trims the ends,
+        # so page numbers at the very start/end of the page are caught below)
+        text = ' '.join(text.split())
         
         # Remove page numbers and headers/footers
-        text = re.sub(r'^\d+\s*', '', text)  # Page numbers at start
-        text = re.sub(r'\s*\d+$', '', text)  # Page numbers at end
-        text = re.sub(r'^(Chapter \d+|CHAPTER \d+|Life 3\.0)', '', text, flags=re.IGNORECASE)
+        text = _LEADING_PAGE_NUMBER_RE.sub('', text)  # Page numbers at start
+        text = _TRAILING_PAGE_NUMBER_RE.sub('', text)  # Page numbers at end
+        text = _HEADER_RE.sub('', text)
         
-        # Fix common PDF extraction issues
-        text = re.sub(r'([a-z])([A-Z])', r'\1 \2', text)  # Add space between joined words
-        text = re.sub(r'([a-zA-Z])(\d)', r'\1 \2', text)  # Space between letters and numbers
-        text = re.sub(r'(\d)([a-zA-Z])', r'\1 \2', text)  # Space between numbers and letters
+        # Fix common PDF extraction issues: one pass adds a space between
+        # joined words, letters and numbers, and numbers and letters
+        # (only one group matches; the others expand to '')
+        text = _JOINED_RE.sub(r'\1\2\3 ', text)
         
         # Clean up punctuation
-        text = re.sub(r'\.{3,}', '...', text)  # Multiple dots to ellipsis
-        text = re.sub(r'-{2,}', ' -- ', text)  # Multiple dashes
-        text = re.sub(r'\s+([,.!?;:])', r'\1', text)  # Remove space before punctuation
-        text = re.sub(r'([,.!?;:])\s*', r'\1 ', text)  # Add single space after punctuation
+        text = _ELLIPSIS_RE.sub('...', text)  # Multiple dots to ellipsis
+        text = _DASHES_RE.sub(' -- ', text)  # Multiple dashes
+        text = _PUNCTUATION_SPACING_RE.sub(r'\1 ', text)  # No space before, one space after punctuation
         
         # Remove unwanted characters but keep essential punctuation
-        text = re.sub(r'[^\w\s.,!?;:\'"()[\]{}\-–—]', '', text)
-        
-        # Fix sentence capitalization
-        sentences = re.split(r'(?<=[.!?])\s+', text)
-        cleaned_sentences = []
+        text = text.translate(_UNWANTED_CHARS_TABLE)
         
-        for sentence in sentences:
-            sentence = sentence.strip()
-            if sentence and len(sentence) > 1:
-                # Capitalize first letter
-                sentence = sentence[0].upper() + sentence[1:]
-                cleaned_sentences.append(sentence)
+        # Fix sentence capitalization (drop empty and one-character fragments)
+        sentences = (sentence.strip() for sentence in _SENTENCE_END_RE.split(text))
+        cleaned_text = ' '.join([
+            sentence[:1].upper() + sentence[1:]
+            for sentence in sentences
+            if len(sentence) > 1
+        ])
         
-        cleaned_text = ' '.join(cleaned_sentences)
-        
-        # Final cleanup
-        cleaned_text = re.sub(r'\s+', ' ', cleaned_text).strip()
+        # Final cleanup: deleted characters can leave double spaces behind
+        cleaned_text = ' '.join(cleaned_text.split())
         
         print(f"   ✅ Text cleaned: {len(cleaned_text)} characters")
         return cleaned_text
     
-    def text_to_speech(self, text, voice_id, play_audio=True, save_audio=True):
+    def split_text_for_tts(self, text, max_chars=1800):
+        """Pack whole sentences into chunks of at most max_chars for separate TTS requests"""
+        chunks = []
+        current = []
+        current_len = 0  # Length of ' '.join(current) plus one trailing space
+        
+        for sentence in _SENTENCE_END_RE.split(text):
+            if current and current_len + len(sentence) > max_chars:
+                chunks.append(' '.join(current))
+                current = []
+                current_len = 0
+            current.append(sentence)
+            current_len += len(sentence) + 1
+        
+        if current:
+            chunks.append(' '.join(current))
+        
+        return chunks
+    
+    async def convert_chunks(self, chunks, voice_id):
+        """Render text chunks concurrently with the async ElevenLabs client, in order"""
+        from elevenlabs.client import AsyncElevenLabs
+        
+        # One pooled connection set for all chunks, so they don't each pay a TLS handshake
+        async with httpx.AsyncClient(http2=_HTTP2, limits=_HTTP_LIMITS, timeout=_HTTP_TIMEOUT) as http_client:
+            client = AsyncElevenLabs(api_key=self.api_key, httpx_client=http_client)
+            
+            async def render(chunk):
+                # Request slots are shared with other threads. Poll instead of blocking
+                # in a worker thread: a cancelled wait then never holds a slot
+                while not self._request_slots.acquire(blocking=False):
+                    await asyncio.sleep(0.05)
+                try:
+                    audio = client.text_to_speech.convert(
+                        text=chunk,
+                        voice_id=voice_id,
+                        model_id="eleven_multilingual_v2",
+                        output_format="mp3_44100_128",
+                    )
+                    # Depending on SDK version this is an async iterator or a coroutine
+                    if inspect.isawaitable(audio):
+                        audio = await audio
+                    return b"".join([part async for part in audio])
+                finally:
+                    self._request_slots.release()
+            
+            return await asyncio.gather(*(render(chunk) for chunk in chunks))
+    
+    def load_cache_index(self):
+        """Load the audio cache index ({key: {text_len, size, mtime}})"""
+        try:
+            with open(self.cache_index_path, 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return {}
+    
+    def update_cache_index(self, key, text_len):
+        """Record a cache hit or new entry and evict least recently used audio"""
+        with self._cache_lock:
+            self._update_cache_index(key, text_len)
+    
+    def _update_cache_index(self, key, text_len):
+        index = self.load_cache_index()
+        
+        cached_path = self.cache_dir / f"{key}.mp3"
+        index[key] = {
+            "text_len": text_len,
+            "size": cached_path.stat().st_size,
+            "mtime": time.time(),
+        }
+        
+        # Evict oldest entries until the cache fits, never the current one
+        total = sum(entry["size"] for entry in index.values())
+        for old_key in sorted(index, key=lambda k: index[k]["mtime"]):
+            if total <= self.cache_max_bytes or old_key == key:
+                break
+            (self.cache_dir / f"{old_key}.mp3").unlink(missing_ok=True)
+            total -= index.pop(old_key)["size"]
+            print(f"   🗑️  Evicted cached audio: {old_key[:12]}")
+        
+        with open(self.cache_index_path, 'w', encoding='utf-8') as f:
+            json.dump(index, f)
+    
+    def text_to_speech(self, text, voice_id, play_audio=True, save_audio=True, filename="life3_page_audio.mp3"):
         """Convert text to speech using ElevenLabs SDK"""
         if not text.strip():
             raise ValueError("No text provided for conversion!")
@@ -129,27 +349,65 @@ class PDFToSpeech:
         print(f"🔊 Converting {len(text)} characters to speech...")
         
         try:
-            # Convert text to speech
-            audio = self.elevenlabs.text_to_speech.convert(
-                text=text,
-                voice_id=voice_id,
-                model_id="eleven_multilingual_v2",
-                output_format="mp3_44100_128",
-            )
+            # Same text, voice, model and format always produce the same audio
+            key = hashlib.sha256(
+                f"{voice_id}|eleven_multilingual_v2|mp3_44100_128|".encode() + text.encode()
+            ).hexdigest()
+            cached_path = self.cache_dir / f"{key}.mp3"
+            
+            if cached_path.exists():
+                print(f"♻️  Reusing cached audio: {cached_path.name}")
+            else:
+                chunks = self.split_text_for_tts(text)
+                
+                # Write audio as it arrives into a temp file of this call's own, then
+                # rename: neither a failed request nor a concurrent writer of the
+                # same key can leave a truncated or interleaved cache entry behind
+                partial = tempfile.NamedTemporaryFile(
+                    dir=self.cache_dir, prefix=f"{key[:12]}-", suffix=".part", delete=False
+                )
+                partial_path = Path(partial.name)
+                try:
+                    with partial as f:
+                        if len(chunks) > 1:
+                            # Long page: render sentence-aligned chunks concurrently. Each result
+                            # is a complete CBR MP3 stream, so the bytes concatenate for playback
+                            print(f"   ⚡ Rendering {len(chunks)} chunks concurrently...")
+                            f.writelines(asyncio.run(self.convert_chunks(chunks, voice_id)))
+                        else:
+                            # Stream speech as the server renders it, holding one request slot
+                            # (elevenlabs 2.x renamed convert_as_stream to stream)
+                            tts_api = self.elevenlabs.text_to_speech
+                            stream = getattr(tts_api, "stream", None) or tts_api.convert_as_stream
+                            with self._request_slots:
+                                f.writelines(stream(
+                                    text=text,
+                                    voice_id=voice_id,
+                                    model_id="eleven_multilingual_v2",
+                                    output_format="mp3_44100_128",
+                                ))
+                    
+                    partial_path.replace(cached_path)
+                finally:
+                    # No-op after a successful rename
+                    partial_path.unlink(missing_ok=True)
+            
+            self.update_cache_index(key, len(text))
             
             # Save audio file if requested
             audio_path = None
             if save_audio:
-                filename = f"life3_page_audio.mp3"
                 audio_path = self.output_dir / filename
                 
-                save(audio, str(audio_path))
+                shutil.copyfile(cached_path, audio_path)
                 print(f"💾 Audio saved to: {audio_path}")
             
             # Play audio if requested
             if play_audio:
+                from elevenlabs import play
+                
                 print("🔊 Playing audio...")
-                play(audio)
+                play(cached_path.read_bytes())
             
             return audio_path
             
@@ -157,7 +415,18 @@ class PDFToSpeech:
             print(f"❌ Error converting text to speech: {e}")
             return None
     
-    def process_pdf_page(self, pdf_path, page_number=1, voice_id=None, play_audio=True):
+    def save_page_text(self, page_number, cleaned_text):
+        """Save cleaned text for review in the background, off the TTS critical path"""
+        text_file = self.output_dir / f"page_{page_number}_text.txt"
+        
+        def write():
+            text_file.write_text(cleaned_text, encoding="utf-8")
+            print(f"📝 Cleaned text saved: {text_file}")
+        
+        # Non-daemon so the write still completes if the process exits first
+        threading.Thread(target=write).start()
+    
+    def process_pdf_page(self, pdf_path, page_number=1, voice_id=None, play_audio=True, debug=False):
         """Complete pipeline: extract page, clean text, and convert to speech"""
         print(f"🚀 Starting PDF to Speech conversion...")
         print(f"📁 PDF: {pdf_path}")
@@ -171,11 +440,9 @@ class PDFToSpeech:
             if not cleaned_text:
                 return None
             
-            # Save cleaned text for review
-            text_file = self.output_dir / f"page_{page_number}_text.txt"
-            with open(text_file, 'w', encoding='utf-8') as f:
-                f.write(cleaned_text)
-            print(f"📝 Cleaned text saved: {text_file}")
+            # Cleaned text dump is a debug artifact
+            if debug:
+                self.save_page_text(page_number, cleaned_text)
             
             # Step 3: Convert to speech
             audio_path = self.text_to_speech(
@@ -189,6 +456,53 @@ class PDFToSpeech:
         except Exception as e:
             print(f"❌ Error in pipeline: {e}")
             return None
+    
+    def process_pdf_pages(self, pdf_path, pages, voice_id=None, max_workers=None, debug=False):
+        """Convert several pages: extract across processes, synthesize each page as it is ready"""
+        pages = list(pages)
+        print(f"🚀 Starting PDF to Speech conversion of {len(pages)} pages...")
+        print(f"📁 PDF: {pdf_path}")
+        
+        results = {}
+        
+        # Extraction is CPU-bound and GIL-bound, TTS is network-bound: a process
+        # pool for the first, a thread pool for the second, overlapping both.
+        # In-flight API requests stay bounded by the shared request slots
+        with ProcessPoolExecutor(max_workers=max_workers) as extract_pool, \
+                ThreadPoolExecutor(max_workers=4) as tts_pool:
+            extract_futures = [extract_pool.submit(_extract_one, (str(pdf_path), page)) for page in pages]
+            tts_futures = {}
+            
+            for future in as_completed(extract_futures):
+                page_number, raw_text = future.result()
+                
+                cleaned_text = self.clean_text(raw_text)
+                if not cleaned_text:
+                    results[page_number] = None
+                    continue
+                
+                if debug:
+                    self.save_page_text(page_number, cleaned_text)
+                
+                tts_future = tts_pool.submit(
+                    self.text_to_speech,
+                    text=cleaned_text,
+                    voice_id=voice_id,
+                    play_audio=False,
+                    filename=f"page_{page_number}_audio.mp3"
+                )
+                tts_futures[tts_future] = page_number
+            
+            for future in as_completed(tts_futures):
+                results[tts_futures[future]] = future.result()
+        
+        return dict(sorted(results.items()))
+
+def _extract_one(args):
+    """Extract one page in a worker process (module-level so it can be pickled)"""
+    # Extraction needs no converter state, so workers never build a client
+    pdf_path, page_number = args
+    return page_number, PDFToSpeech.extract_page_text(pdf_path, page_number)
 
 def main():
     """Main execution function"""
@@ -213,8 +527,10 @@ def main():
         pdf_path=pdf_file,
         page_number=page_to_convert,
         voice_id=voice_id,
-        play_audio=False
+        play_audio=False,
+        debug=True  # Keep page_<n>_text.txt: clone_speech.py narrates from it
     )
+    converter.close()
 
     if result:
         print(f"\n🎉 Success! Your audiobook page is ready!")